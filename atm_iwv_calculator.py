@@ -10,27 +10,69 @@ Este script contiene las funciones necesarias para realizar los calculos del IWV
 Además, de ejecutarlo, se obtiene el valor del IWV actual empleando la formula.
 """
 
+import functools
 import math
+import numpy as np
+import pandas as pd
+
+# Numba es opcional: si no está instalado, las funciones se ejecutan en Python puro.
+# Solo se importa la primera vez que se llama a una función compilada, para que quien use
+# únicamente las versiones vectorizadas (como iwv_graphs.py) no pague el tiempo de importarlo
+prange = range
+_JIT_FUNCS = {}
+
+def _compile_jit_funcs():
+    """Sustituye en el módulo cada función marcada con njit por su versión compilada con Numba (si está instalado)."""
+    global prange
+    try:
+        import numba
+    except ImportError:
+        numba = None
+    else:
+        prange = numba.prange
+    # Las funciones compiladas se llaman entre sí por su nombre global, así que se sustituyen todas a la vez
+    for name, (func, options) in _JIT_FUNCS.items():
+        globals()[name] = numba.njit(**options)(func) if numba else func
+
+def njit(**options):
+    """Marca una función para compilarla con Numba cuando se llame por primera vez."""
+    def decorator(func):
+        _JIT_FUNCS[func.__name__] = (func, options)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            if globals()[func.__name__] is wrapper:
+                _compile_jit_funcs()
+            return globals()[func.__name__](*args)
+        return wrapper
+    return decorator
+
+# Constantes de la fórmula del punto de rocío
+_A = 17.62
+_B = 243.12  # °C
+
+# Masa de la molécula de agua entre la constante de Boltzmann
+_MH2O_OVER_KB = 1.66053886e-27 * 18 / 1.3806503e-23
 
 # Formulas sacadas del código en Java del 40M #######################################################
+# Sin fastmath: con él Numba supone que no hay NaN, y una humedad NaN debe dar NaN como en la versión vectorizada
+@njit(cache=True)
 def dew_temperature(temperatura_c:float, humedad_relativa:float):
     """
     Calcula el punto de rocío (en °C) usando la fórmula.
     """
-    a = 17.62
-    b = 243.12  # °C
+    if humedad_relativa < 0 or humedad_relativa > 100:
+        raise ValueError("La humedad relativa debe estar entre 0 y 100%.")
 
-    # Para evitar problemas con el 0
+    # Para evitar problemas con el 0 (un NaN se mantiene como NaN)
     if humedad_relativa < 0.01:
         humedad_relativa = 0.01
 
-    if humedad_relativa < 0 or humedad_relativa > 100:
-        raise ValueError("La humedad relativa debe estar entre 0 y 100%.")
-
-    alpha = ((a * temperatura_c) / (b + temperatura_c)) + math.log(humedad_relativa / 100.0)
-    punto_rocio = (b * alpha) / (a - alpha)
+    alpha = ((_A * temperatura_c) / (_B + temperatura_c)) + math.log(humedad_relativa / 100.0)
+    punto_rocio = (_B * alpha) / (_A - alpha)
     return punto_rocio
 
+@njit(cache=True)
 def calc_iwv_wh2o(surface_temp: float, humedad_relativa: float, scale_factor_H: float):
     """
     Calcula el IWV usando el punto de rocío.
@@ -51,8 +93,29 @@ def calc_iwv_wh2o(surface_temp: float, humedad_relativa: float, scale_factor_H:
     # resultado
     wh2omm = mh2o * ph2o * scale_factor_H / (kb * tk)
     return wh2omm
+
+def calc_iwv_wh2o_vec(surface_temp, humedad_relativa, scale_factor_H: float):
+    """
+    Versión vectorizada de calc_iwv_wh2o para arrays de NumPy.
+    """
+    temp = np.asarray(surface_temp, dtype=np.float64)
+    hum = np.asarray(humedad_relativa, dtype=np.float64)
+    if np.any((hum < 0) | (hum > 100)):
+        raise ValueError("La humedad relativa debe estar entre 0 y 100%.")
+
+    # Para evitar problemas con el 0
+    hum = np.clip(hum, 0.01, 100)
+
+    alpha = ((_A * temp) / (_B + temp)) + np.log(hum / 100.0)
+    # tdew / (tdew + 237.15) sustituyendo tdew = b * alpha / (a - alpha)
+    b_alpha = _B * alpha
+    ratio = b_alpha / (b_alpha + 237.15 * (_A - alpha))
+    ph2o = np.exp(1.81 + 17.27 * ratio) * 100  # Pa
+    return _MH2O_OVER_KB * ph2o * scale_factor_H / (temp + 273.15)
 # Fin de las formulas del 40M ##################################################################
 
+# Sin fastmath, igual que en las fórmulas del 40M: las lecturas no válidas llegan como NaN y deben dar NaN
+@njit(cache=True)
 def calc_iwv(surface_temp: float, scale_factor_H: float, humidity: float):
     """
     Calcula el IWV a partir de temperatura superficial, factor de escala y humedad relativa.
@@ -61,12 +124,40 @@ def calc_iwv(surface_temp: float, scale_factor_H: float, humidity: float):
     iwv = 1.3227e-2 * ((numerador) / (surface_temp + 273)) * humidity * scale_factor_H
     return iwv
 
+@njit(cache=True, parallel=True)
+def calc_iwv_batch(surface_temp, scale_factor_H, humidity, out):
+    """
+    Calcula calc_iwv para cada elemento de los arrays y lo guarda en 'out'.
+    Con Numba el bucle se reparte entre varios hilos.
+    """
+    for i in prange(len(surface_temp)):
+        out[i] = calc_iwv(surface_temp[i], scale_factor_H, humidity[i])
+    return out
+
+def calc_iwv_vec(surface_temp, scale_factor_H: float, humidity):
+    """
+    Versión vectorizada de calc_iwv para arrays de NumPy.
+    """
+    temp = np.asarray(surface_temp, dtype=np.float64)
+    hum = np.asarray(humidity, dtype=np.float64)
+    numerador = np.exp(17.27 * temp / (temp + 237.7))
+    return 1.3227e-2 * (numerador / (temp + 273)) * hum * scale_factor_H
+
 def clean_value(val, unit):
     """
     Limpia el valor numérico de una cadena con unidad.
     """
     return float(val.replace(unit, '').replace(',', '.').strip())
 
+def clean_column(serie):
+    """
+    Versión vectorizada de clean_value para una columna de pandas.
+    Extrae el número al principio de cada cadena (con coma o punto decimal y exponente opcional), sea cual sea la unidad.
+    Los valores que no se pueden convertir quedan como NaN.
+    """
+    numero = serie.astype(str).str.extract(r"^\s*([-+]?(?:\d+(?:[.,]\d*)?|[.,]\d+)(?:[eE][-+]?\d+)?)")[0]
+    return pd.to_numeric(numero.str.replace(',', '.', regex=False), errors='coerce')
+
 def main():
     return
 
@@ -9,16 +9,16 @@ Descarga archivos de IWV desde el IGN, los convierte a CSV y los guarda en ./dat
 - Descarga los archivos especificados en data_files.
 - Convierte cada archivo de texto a CSV con columnas: fecha, valor.
 - Guarda los CSV en el directorio ./data.
-- El archivo TXT descargado se elimina tras la conversión.
+- El archivo TXT se procesa en memoria, sin guardarlo en disco.
 
 Uso:
 $ python3 get_gnss_csv.py
 """
 
 import os
-import csv
-import wget
 import sys
+import pandas as pd
+import requests
 
 # Opción de ayuda
 if '-h' in sys.argv or '--help' in sys.argv:
@@ -35,33 +35,37 @@ url = "https://datos-geodesia.ign.es/Utilidades/compresores/IWV/"
 output_dir = "./data"
 os.makedirs(output_dir, exist_ok=True)
 
-for file in data_files:
-    print(f"Descargando {file}...")
-    input_file = wget.download(url + file)
-    print(f"\nProcesando {input_file}...")
-
-    output_file = os.path.join(output_dir, os.path.splitext(file)[0] + ".csv")
-
-    # Si el archivo CSV ya existe, lo sobreescribe
-    if os.path.exists(output_file):
-        print(f"El archivo {output_file} ya existe y será sobreescrito.")
-
-    with open(input_file, 'r') as infile, open(output_file, 'w', newline='') as outfile:
-        writer = csv.writer(outfile)
-        writer.writerow(["fecha", "valor"])  # Cabecera CSV
-
-        for line in infile:
-            fields = line.strip().split()
-            if len(fields) != 6:
-                continue  # Salta líneas mal formateadas
-
-            year, month, day, hour, minute, value = fields
-            formatted_date = f"{int(year):04d}-{int(month):02d}-{int(day):02d} {int(hour):02d}:{int(minute):02d}:00"
-            writer.writerow([formatted_date, value])
-
-    # Elimina el archivo TXT descargado
-    os.remove(input_file)
-    print(f"Archivo temporal {input_file} eliminado.")
-    print(f"Conversión completada. El archivo CSV se ha guardado como '{output_file}'.")
+# La sesión reutiliza la conexión entre descargas
+with requests.Session() as session:
+    for file in data_files:
+        print(f"Descargando {file}...")
+        respuesta = session.get(url + file, stream=True)
+        respuesta.raise_for_status()
+        # Se lee directamente de la respuesta HTTP, sin fichero temporal
+        respuesta.raw.decode_content = True
+        input_file = respuesta.raw
+        print(f"Procesando {file}...")
+
+        output_file = os.path.join(output_dir, os.path.splitext(file)[0] + ".csv")
+
+        # Si el archivo CSV ya existe, lo sobreescribe
+        if os.path.exists(output_file):
+            print(f"El archivo {output_file} ya existe y será sobreescrito.")
+
+        # Columnas: año, mes, día, hora, minuto, valor
+        df = pd.read_csv(input_file, sep=r'\s+', header=None, names=['y', 'm', 'd', 'H', 'M', 'v'],
+                         dtype=str, on_bad_lines='skip')
+
+        # Salta líneas mal formateadas (campos ausentes o no numéricos)
+        campos_fecha = df[['y', 'm', 'd', 'H', 'M']].apply(pd.to_numeric, errors='coerce')
+        valido = campos_fecha.notna().all(axis=1) & pd.to_numeric(df['v'], errors='coerce').notna()
+        df, campos_fecha = df[valido], campos_fecha[valido].astype(int)
+
+        fechas = pd.to_datetime(dict(year=campos_fecha['y'], month=campos_fecha['m'], day=campos_fecha['d'],
+                                     hour=campos_fecha['H'], minute=campos_fecha['M']))
+        salida = pd.DataFrame({'fecha': fechas, 'valor': df['v']})
+        salida.to_csv(output_file, index=False, date_format='%Y-%m-%d %H:%M:%S')
+
+        print(f"Conversión completada. El archivo CSV se ha guardado como '{output_file}'.")
 
 print("Terminado")
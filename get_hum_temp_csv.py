@@ -4,14 +4,18 @@ Script para descargar datos de temperatura y humedad de una base de datos MySQL
 usando credenciales y una consulta SQL filtrada por año.
 
 Uso:
-    python3 get_hum_temp_csv.py --host HOST --user USER --pass PASSWORD --db DATABASE --year YEAR
+    python3 get_hum_temp_csv.py --host HOST --user USER --pass PASSWORD --db DATABASE --year YEAR [--zstd]
 
-Guarda los resultados en data/HumTemp_YEAR.csv
+Guarda los resultados en data/HumTemp_YEAR.csv (o data/HumTemp_YEAR.csv.zst con --zstd)
 """
 
 import argparse
-import csv
 import MySQLdb
+import MySQLdb.cursors
+import pandas as pd
+
+# Número de filas que se leen del servidor en cada bloque
+FETCH_BATCH = 10000
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Descarga datos de temperatura y humedad de una base de datos MySQL remota.")
@@ -20,6 +24,7 @@ def parse_args():
     parser.add_argument('--pwd', required=True, help='Contraseña de la base de datos')
     parser.add_argument('--db', required=True, help='Nombre de la base de datos')
     parser.add_argument('--year', type=int, required=True, help='Año a consultar')
+    parser.add_argument('--zstd', action='store_true', help='Guarda el CSV comprimido con Zstandard (.csv.zst)')
     return parser.parse_args()
 
 def main():
@@ -30,28 +35,40 @@ def main():
         host=args.host,
         user=args.user,
         passwd=args.pwd,
-        db=args.db
+        db=args.db,
+        cursorclass=MySQLdb.cursors.SSCursor  # Cursor en servidor: no carga todo el resultado en memoria
     )
     cursor = conn.cursor()
 
-    # Consulta SQL
-    sql = f"""
+    # Consulta SQL (rango sobre ts para poder usar su índice)
+    sql = """
         SELECT ts, temp, hum
         FROM weatherlog
-        WHERE YEAR(ts) = {args.year}
+        WHERE ts >= %s AND ts < %s
         ORDER BY ts
     """
 
-    cursor.execute(sql)
-    rows = cursor.fetchall()
+    cursor.execute(sql, (f"{args.year}-01-01", f"{args.year + 1}-01-01"))
 
-    # Guardar resultados en CSV
+    # Guardar resultados en CSV por bloques según llegan del servidor
     output_file = f"data/HumTemp_{args.year}.csv"
-    with open(output_file, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(['ts', 'temp', 'hum'])
-        for row in rows:
-            writer.writerow(row)
+    if args.zstd:
+        # Un único flujo comprimido para todos los bloques
+        import zstandard
+        output_file += ".zst"
+        csvfile = zstandard.open(output_file, 'w', cctx=zstandard.ZstdCompressor(level=6), newline='')
+    else:
+        csvfile = open(output_file, 'w', newline='')
+
+    columns = ['ts', 'temp', 'hum']
+    with csvfile:
+        csvfile.write(",".join(columns) + "\n")
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH)
+            if not rows:
+                break
+            pd.DataFrame(list(rows), columns=columns).to_csv(
+                csvfile, header=False, index=False, date_format='%Y-%m-%d %H:%M:%S')
 
     print(f"Datos guardados en {output_file}")
 
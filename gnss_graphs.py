@@ -14,21 +14,26 @@ Funcionamiento:
 - Guarda las gráficas y el archivo de medias en formato CSV.
 
 Uso:
-    python3 gnss_graphs.py -y YEAR -w WINDOW -f file1.csv file2.csv ...
+    python3 gnss_graphs.py -y YEAR -w WINDOW -f file1.csv file2.csv ... [--show] [--zstd]
 """
 
-import csv
 import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import List, Dict
+from typing import List
+import numpy as np
+import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 import os
 
 # Estructuras globales para almacenar los datos de cada estación y el resultado combinado
-fechas_arrs: List[List[datetime]] = []
-data_arrs: List[List[float]] = []
-data_avg_arrs: List[List[float]] = []
-final_result: Dict[datetime, float] = {}
+fechas_arrs: List[np.ndarray] = []
+data_arrs: List[np.ndarray] = []
+data_avg_arrs: List[np.ndarray] = []
+final_fechas: np.ndarray = np.array([], dtype='datetime64[ns]')
+final_result: np.ndarray = np.array([], dtype=np.float64)
 
 def parse_args():
     """
@@ -37,41 +42,50 @@ def parse_args():
     -w WINDOW: tamaño de la ventana para la media móvil centrada
     -f FILES: lista de archivos CSV de entrada
     --show: si está presente, muestra los gráficos además de guardarlos
+    --zstd: si está presente, guarda el archivo de medias comprimido con Zstandard
     """
     parser = argparse.ArgumentParser(description="Procesa y grafica valores de IWV de estaciones GNSS.")
     parser.add_argument('-y', '--year', type=int, default=datetime.now().year, help='Año a analizar (por defecto, año actual)')
     parser.add_argument('-w', '--window', type=int, default=250, help='Tamaño de la ventana para la media móvil centrada')
     parser.add_argument('-f', '--files', nargs='+', required=True, help='Lista de archivos CSV de entrada')
     parser.add_argument('--show', action='store_true', help='Muestra los gráficos en pantalla además de guardarlos')
+    parser.add_argument('--zstd', action='store_true', help='Guarda el archivo de medias comprimido (.csv.zst)')
     return parser.parse_args()
 
-def filter_date(fecha: datetime, year: int) -> bool:
+def year_of(fechas: np.ndarray) -> np.ndarray:
+    """
+    Devuelve el año de cada fecha de un array datetime64.
+    """
+    return fechas.astype('datetime64[Y]').astype(int) + 1970
+
+def filter_date(fechas: np.ndarray, year: int) -> np.ndarray:
     """
     Filtra fechas del año actual, últimos 15 días de diciembre anterior y primeros 15 días de enero siguiente.
     Esto mejora el cálculo de la media móvil en los extremos del año.
+    Devuelve una máscara booleana para el array datetime64 'fechas'.
     """
-    if fecha.year == year:
-        return True
-    if fecha.year == (year - 1) and fecha.month == 12 and fecha.day >= 15:
-        return True
-    if fecha.year == (year + 1) and fecha.month == 1 and fecha.day <= 15:
-        return True
-    return False
+    ts = fechas.astype('datetime64[D]')
+    inicio_mes = ts.astype('datetime64[M]')
+    yr = year_of(ts)
+    mon = inicio_mes.astype(int) % 12 + 1
+    day = (ts - inicio_mes).astype(int) + 1
+    return ((yr == year)
+            | ((yr == year - 1) & (mon == 12) & (day >= 15))
+            | ((yr == year + 1) & (mon == 1) & (day <= 15)))
 
-def avg_calc(date_arr: List[datetime], iwv_arr: List[float], window: int = 500, year: int = None) -> List[float]:
+def avg_calc(iwv_arr: np.ndarray, window: int = 500) -> np.ndarray:
     """
     Calcula la media móvil centrada para los datos de IWV.
-    Para cada punto, toma una ventana de tamaño 'window' a izquierda y derecha.
-    """
-    n = len(iwv_arr)
-    result = []
-    for pos, fecha in enumerate(date_arr):
-        if year is None or fecha.year == year:
-            left = max(0, pos - window)
-            right = min(n, pos + window + 1)
-            window_vals = iwv_arr[left:right]
-            result.append(sum(window_vals) / len(window_vals))
-    return result
+    Para cada punto, toma una ventana de tamaño 'window' a izquierda y derecha (2*window+1 muestras, siempre impar).
+    Usa sumas acumuladas para obtener todas las medias en O(N).
+    """
+    arr = np.asarray(iwv_arr, dtype=np.float64)
+    n = len(arr)
+    suma_acum = np.concatenate(([0.0], np.cumsum(arr)))
+    pos = np.arange(n)
+    left = np.maximum(0, pos - window)
+    right = np.minimum(n, pos + window + 1)
+    return (suma_acum[right] - suma_acum[left]) / (right - left)
 
 def read_station_data(file: str, year: int) -> tuple:
     """
@@ -79,57 +93,85 @@ def read_station_data(file: str, year: int) -> tuple:
     - fechas e IWV del año principal
     - fechas e IWV extendidas para la media móvil
     """
-    curr_date_arr, curr_iwv_arr = [], []
-    curr_date_arr_ext, curr_iwv_arr_ext = [], []
-
-    with open(file, 'r') as cf:
-        lector = csv.reader(cf)
-        next(lector)  # Saltar encabezado
-        for fila in lector:
-            if not fila:
-                continue
-            fecha_str, valor_str = fila
-            fecha = datetime.strptime(fecha_str.strip(), '%Y-%m-%d %H:%M:%S')
-            iwv = float(valor_str.strip()) * 1000  # Convertir a mm
-
-            if fecha.year == year:
-                curr_date_arr.append(fecha)
-                curr_iwv_arr.append(iwv)
-                # Promediar para la serie combinada
-                if fecha not in final_result:
-                    final_result[fecha] = iwv
-                else:
-                    final_result[fecha] = (final_result[fecha] + iwv) / 2
-
-            if filter_date(fecha, year):
-                curr_date_arr_ext.append(fecha)
-                curr_iwv_arr_ext.append(iwv)
+    df = pd.read_csv(file, names=['fecha', 'valor'], header=0, skipinitialspace=True,
+                     parse_dates=['fecha'], date_format='%Y-%m-%d %H:%M:%S',
+                     dtype={'valor': np.float64})
+    df = df.dropna()
+    df['valor'] *= 1000  # Convertir a mm
+
+    fechas = df['fecha'].to_numpy(dtype='datetime64[ns]')
+    valores = df['valor'].to_numpy()
+    mask_year = year_of(fechas) == year
+    mask_ext = filter_date(fechas, year)
+
+    curr_date_arr = fechas[mask_year]
+    curr_iwv_arr = valores[mask_year]
+    curr_date_arr_ext = fechas[mask_ext]
+    curr_iwv_arr_ext = valores[mask_ext]
 
     return curr_date_arr, curr_iwv_arr, curr_date_arr_ext, curr_iwv_arr_ext
 
 def save_data(files: List[str], year: int, window: int):
     """
     Lee los archivos pasados y almacena los datos en las estructuras globales.
+    La serie combinada es la media de todas las estaciones para cada fecha.
     """
-    for curr_file in files:
-        curr_date_arr, curr_iwv_arr, curr_date_arr_ext, curr_iwv_arr_ext = read_station_data(curr_file, year)
+    global final_fechas, final_result
+    station_times, station_iwv = [], []
+    # Cada estación se lee en un proceso distinto
+    with ProcessPoolExecutor() as ex:
+        station_data = list(ex.map(functools.partial(read_station_data, year=year), files))
+
+    for curr_date_arr, curr_iwv_arr, curr_date_arr_ext, curr_iwv_arr_ext in station_data:
         fechas_arrs.append(curr_date_arr)
         data_arrs.append(curr_iwv_arr)
-        data_avg_arrs.append(avg_calc(curr_date_arr_ext, curr_iwv_arr_ext, window, year))
+        # La media se calcula sobre el rango extendido y después se recorta al año
+        data_avg_arrs.append(avg_calc(curr_iwv_arr_ext, window)[year_of(curr_date_arr_ext) == year])
+        station_times.append(curr_date_arr)
+        station_iwv.append(curr_iwv_arr)
 
-def save_avg_data(fecha_arr: List[datetime], iwv_arr: List[float], year: int):
+    # np.unique devuelve las fechas ordenadas; bincount suma y cuenta los valores de cada fecha
+    all_times = np.concatenate(station_times)
+    all_iwv = np.concatenate(station_iwv)
+    final_fechas, inv = np.unique(all_times, return_inverse=True)
+    final_result = np.bincount(inv, weights=all_iwv) / np.bincount(inv)
+
+def save_avg_data(fecha_arr: np.ndarray, iwv_arr: np.ndarray, year: int, compress: bool = False):
     """
     Guarda la serie combinada de medias en un archivo CSV.
+    Si compress es True, lo guarda comprimido con Zstandard (.csv.zst).
     """
     os.makedirs("data", exist_ok=True)
     output_file = f"data/Avg_data_{year}.csv"
-    with open(output_file, 'w', newline='') as outfile:
-        writer = csv.writer(outfile)
-        writer.writerow(["Time", "IWV"])
-        for i in range(0, len(fecha_arr)):
-            writer.writerow([fecha_arr[i], iwv_arr[i]])
+    compression = None
+    if compress:
+        output_file += ".zst"
+        compression = {'method': 'zstd', 'level': 6}
+    pd.DataFrame({"Time": fecha_arr, "IWV": iwv_arr}).to_csv(output_file, index=False, date_format='%Y-%m-%d %H:%M:%S',
+                                                             compression=compression)
     print(f"Nuevo fichero con las medias guardado en {output_file}")
 
+def _decimate(x, y, max_pts: int = 4000) -> tuple:
+    """
+    Reduce una serie a unos 'max_pts' puntos para graficarla.
+    Divide la serie en tramos y conserva el mínimo y el máximo de cada uno, manteniendo los extremos visibles.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    n = len(y)
+    if n <= max_pts:
+        return x, y
+
+    bin_size = -(-n // (max_pts // 2))
+    n_bins = -(-n // bin_size)
+    bins = np.full(n_bins * bin_size, np.nan)
+    bins[:n] = y
+    bins = bins.reshape(n_bins, bin_size)
+
+    offset = np.arange(n_bins) * bin_size
+    idx = np.sort(np.column_stack((offset + np.nanargmin(bins, axis=1),
+                                   offset + np.nanargmax(bins, axis=1))), axis=1).ravel()
+    return np.asarray(x)[idx], y[idx]
+
 def plot_station_data(files: List[str], year: int, window: int, show_plots: bool):
     """
     Grafica los datos originales y la media móvil de cada estación GNSS.
@@ -141,9 +183,9 @@ def plot_station_data(files: List[str], year: int, window: int, show_plots: bool
     plt.ylabel("IWV (mm)")
     plt.xticks(rotation=45)
     plt.grid()
-    for idx, (curr_dates, curr_data, curr_avg_data) in enumerate(zip(fechas_arrs, data_arrs, data_avg_arrs), start=1):
-        label_base = files[idx - 1].split("/")[-1].split("_")[0]
-        plt.plot(curr_dates, curr_data, linestyle='-', label=f'Data {label_base}')
+    labels = [os.path.basename(f).split("_")[0] for f in files]
+    for label_base, curr_dates, curr_data, curr_avg_data in zip(labels, fechas_arrs, data_arrs, data_avg_arrs):
+        plt.plot(*_decimate(curr_dates, curr_data), linestyle='-', label=f'Data {label_base}')
         plt.plot(curr_dates, curr_avg_data, linestyle='-', label=f'Average {label_base}')
     plt.legend(loc='best')
     plt.tight_layout()
@@ -153,16 +195,17 @@ def plot_station_data(files: List[str], year: int, window: int, show_plots: bool
         plt.show()
     plt.close()
 
-def plot_combined_data(year: int, window: int, show_plots: bool):
+def plot_combined_data(year: int, window: int, show_plots: bool, compress: bool = False):
     """
     Grafica la serie combinada (media de estaciones) y su media móvil centrada.
     Si show_plots es True, muestra los gráficos en pantalla.
+    Si compress es True, el archivo de medias se guarda comprimido.
     """
-    sorted_dates = sorted(final_result)
-    values = [final_result[fecha] for fecha in sorted_dates]
-    avg_values = avg_calc(sorted_dates, values, window, year)
+    sorted_dates = final_fechas
+    values = final_result
+    avg_values = avg_calc(values, window)
 
-    save_avg_data(sorted_dates, avg_values, year)
+    save_avg_data(sorted_dates, avg_values, year, compress)
 
     plt.figure(figsize=(12, 6))
     plt.title("Zenith IWV values")
@@ -170,7 +213,7 @@ def plot_combined_data(year: int, window: int, show_plots: bool):
     plt.ylabel("IWV (mm)")
     plt.xticks(rotation=45)
     plt.grid()
-    plt.plot(sorted_dates, values, linestyle='-', color='c', label='Average value of GNSS stations')
+    plt.plot(*_decimate(sorted_dates, values), linestyle='-', color='c', label='Average value of GNSS stations')
     plt.plot(sorted_dates, avg_values, linestyle='-', color='red', label='Moving average')
     plt.legend(loc='best')
     plt.tight_layout()
@@ -185,9 +228,12 @@ def main():
     Flujo principal del script.
     """
     args = parse_args()
+    # Sin --show basta con el backend no interactivo
+    if not args.show:
+        matplotlib.use("Agg")
     save_data(args.files, args.year, args.window)
     plot_station_data(args.files, args.year, args.window, args.show)
-    plot_combined_data(args.year, args.window, args.show)
+    plot_combined_data(args.year, args.window, args.show, args.zstd)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
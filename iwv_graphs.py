@@ -7,9 +7,10 @@ Descripción:
 Calcula y representa el IWV a partir de un archivo combinado de humedad y temperatura, y lo compara con los datos de Avg_data.csv.
 
 Funcionamiento:
-- Lee el archivo 'data/HumTemp_{year}.csv' con columnas ts, temp, hum.
+- Lee el archivo 'data/HumTemp_{year}.csv' (o su versión comprimida '.csv.zst', si es más reciente) con columnas ts, temp, hum.
 - Filtra solo los datos a las horas: en punto, cuarto, media y menos cuarto.
 - Limpia y convierte los valores numéricos.
+- Guarda los datos ya filtrados en 'data/.cache' (Parquet) para reutilizarlos mientras el CSV no cambie.
 - Calcula el IWV para cada instante por el método especificado.
 - Guarda los resultados en CSV.
 - Lee el archivo 'Avg_data_{year}.csv' y representa los IWV calculados junto al dato de referencia.
@@ -19,12 +20,25 @@ Uso:
     python3 iwv_graphs.py [-h] [-y YEAR] [-hf H_FACTOR] [--show]
 """
 
+import numpy as np
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
 import argparse
 import atm_iwv_calculator as atm_c
+import hashlib
 import os
 
+# Si pyarrow está instalado se usa su lector de CSV (multihilo); si no, el de pandas
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+CACHE_DIR = "data/.cache"
+CACHE_VERSION = 2  # Subir si cambia la limpieza de los datos, para no reutilizar cachés antiguas
+
 def parse_args():
     """Parsea los argumentos de la terminal."""
     parser = argparse.ArgumentParser(description="Calcula y representa IWV a partir de humedad y temperatura.")
@@ -35,36 +49,73 @@ def parse_args():
 
 def filter_quarter_hours(df):
     """
-    Filtra el DataFrame para mantener solo las horas: en punto (00), cuarto (15), media (30) y menos cuarto (45).
+    Filtra el DataFrame (con la columna 'Time' ya convertida a fecha) para mantener solo las horas: en punto (00), cuarto (15), media (30) y menos cuarto (45).
     """
-    df['Time'] = pd.to_datetime(df['Time'])
-    # Filtrar por minutos: 00, 15, 30, 45
-    quarter_hours = df[df['Time'].dt.minute.isin([0, 15, 30, 45])]
+    # Filtrar por minutos: 00, 15, 30, 45 (minutos desde epoch múltiplos de 15)
+    minutos = df['Time'].to_numpy().astype('datetime64[m]').astype('i8')
+    quarter_hours = df[minutos % 15 == 0]
     return quarter_hours
 
+def data_file(name):
+    """Ruta de un fichero de datos: si existen la versión normal (.csv) y la comprimida (.csv.zst), usa la más reciente."""
+    plain = f"data/{name}.csv"
+    compressed = f"data/{name}.csv.zst"
+    if not os.path.exists(compressed):
+        return plain
+    if not os.path.exists(plain):
+        return compressed
+    return compressed if os.path.getmtime(compressed) > os.path.getmtime(plain) else plain
+
+def humtemp_cache_path(csv_file, year):
+    """Ruta del Parquet en caché, que depende del año, del fichero leído, de su fecha de modificación y de CACHE_VERSION."""
+    key = hashlib.md5(f"{CACHE_VERSION}-{year}-{csv_file}-{os.path.getmtime(csv_file)}".encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f"humtemp_{year}_{key}.parquet")
+
+def remove_old_humtemp_cache(cache_file, year):
+    """Borra las cachés anteriores del mismo año, que ya no se van a usar."""
+    prefix = f"humtemp_{year}_"
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        # También se borran las de formato antiguo (humtemp_<md5>.parquet), que no indican el año
+        old_format = name.startswith("humtemp_") and name.count("_") == 1
+        if (name.startswith(prefix) or old_format) and path != cache_file:
+            os.remove(path)
+
 def load_humtemp(year):
     """Carga y limpia el fichero combinado de humedad y temperatura."""
-    df = pd.read_csv(f"data/HumTemp_{year}.csv")
-    df["ts"] = pd.to_datetime(df["ts"])
+    csv_file = data_file(f"HumTemp_{year}")
+    cache_file = humtemp_cache_path(csv_file, year)
+    if os.path.exists(cache_file):
+        return pd.read_parquet(cache_file)
+
+    df = pd.read_csv(csv_file, parse_dates=["ts"], engine=CSV_ENGINE)
     df = df.rename(columns={"ts": "Time", "temp": "Temp", "hum": "Humedad Relativa"})
+    # Quitar unidades si los valores vienen como texto (ej: "21,5°C", "60%H")
+    for col in ("Temp", "Humedad Relativa"):
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            df[col] = atm_c.clean_column(df[col])
     # Filtrar solo datos de cuartos de hora
     df = filter_quarter_hours(df)
+
+    # Guardar en caché si hay soporte para Parquet (pyarrow o fastparquet)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(cache_file)
+        remove_old_humtemp_cache(cache_file, year)
+    except ImportError:
+        pass
     return df
 
 def load_avg_data(year):
     """Carga el fichero de IWV de referencia."""
-    df_avg = pd.read_csv(f"data/Avg_data_{year}.csv")
-    df_avg["Time"] = pd.to_datetime(df_avg["Time"])
+    df_avg = pd.read_csv(data_file(f"Avg_data_{year}"), parse_dates=["Time"], engine=CSV_ENGINE)
     # Filtrar solo datos de cuartos de hora
     df_avg = filter_quarter_hours(df_avg)
     return df_avg
 
 def calculate_iwv(df, h_scale_factor):
     """Calcula IWV por el método clásico y añade columna IWV al DataFrame."""
-    iwv_list = []
-    for _, row in df.iterrows():
-        iwv = atm_c.calc_iwv(row["Temp"], h_scale_factor, row["Humedad Relativa"])
-        iwv_list.append(iwv)
+    iwv_list = atm_c.calc_iwv_vec(df["Temp"].to_numpy(), h_scale_factor, df["Humedad Relativa"].to_numpy())
     df["IWV"] = iwv_list
     return iwv_list
 
@@ -76,9 +127,10 @@ def save_iwv_results(df, year, h_scale_factor):
 
 def plot_iwv(df, df_avg, iwv_list, year, h_scale_factor, show_plots):
     """Grafica los IWV calculados y los de referencia."""
+    # float32 y datetime64[s] son suficientes para la resolución de la gráfica
     plt.figure(figsize=(12, 6))
-    plt.plot(df_avg["Time"], df_avg["IWV"], label="IWV GNSS values")
-    plt.plot(df["Time"], iwv_list, label=f"Atmospheric Parameters (H Factor = {h_scale_factor})")
+    plt.plot(df_avg["Time"].to_numpy(dtype="datetime64[s]"), df_avg["IWV"].to_numpy(dtype=np.float32), label="IWV GNSS values")
+    plt.plot(df["Time"].to_numpy(dtype="datetime64[s]"), np.asarray(iwv_list, dtype=np.float32), label=f"Atmospheric Parameters (H Factor = {h_scale_factor})")
     plt.xlabel("Date")
     plt.ylabel("IWV")
     plt.title(f"Calculated IWV vs. IWV GNSS value {year} (H Factor = {h_scale_factor})")
@@ -96,25 +148,23 @@ def plot_errors(df, df_avg, iwv_list, h_scale_factor, show_plots):
     Grafica los errores absolutos entre:
     - Avg_data vs método clásico
     """
-    df_methods = pd.DataFrame({
-        "Time": df["Time"],
-        "IWV_clasico": iwv_list
-    }).set_index("Time")
-
-    # Eliminar duplicados en el índice (mantener el primero)
-    df_methods = df_methods[~df_methods.index.duplicated(keep='first')]
-    df_avg = df_avg.set_index("Time")
-    df_avg = df_avg[~df_avg.index.duplicated(keep='first')]
+    # Ordenar y eliminar duplicados (mantener el primero) en ambas series
+    df_ref = (df_avg[["Time", "IWV"]].astype({"Time": "datetime64[ns]"})
+              .sort_values("Time", kind="stable").drop_duplicates("Time"))
+    df_methods = (pd.DataFrame({"Time": df["Time"], "IWV_clasico": iwv_list}).astype({"Time": "datetime64[ns]"})
+                  .sort_values("Time", kind="stable").drop_duplicates("Time"))
 
-    # Reindexar para que coincidan los tiempos
-    df_methods_interp = df_methods.reindex(df_avg.index, method='nearest')
+    # Emparejar cada dato de referencia con el calculado más cercano (sin emparejar muestras a más de 10 minutos)
+    joined = pd.merge_asof(df_ref, df_methods, on="Time", direction="nearest", tolerance=pd.Timedelta('10min'))
 
     # Cálculo de errores absolutos
-    error_avg_clasico = (df_avg["IWV"] - df_methods_interp["IWV_clasico"]).abs()
+    error_avg_clasico = (joined["IWV"] - joined["IWV_clasico"]).abs()
+    error_avg_clasico.index = joined["Time"]
+    error_avg_clasico = error_avg_clasico.dropna()
 
     # Gráfica
     plt.figure(figsize=(12, 6))
-    plt.plot(df_avg.index, error_avg_clasico, label=f"|Avg - Formula iwv| (H={h_scale_factor})")
+    plt.plot(error_avg_clasico.index.to_numpy(dtype="datetime64[s]"), error_avg_clasico.to_numpy(dtype=np.float32), label=f"|Avg - Formula iwv| (H={h_scale_factor})")
     plt.xlabel("Fecha")
     plt.ylabel("Error absoluto IWV")
     plt.title(f"Errores absolutos de IWV (H Factor = {h_scale_factor})")
@@ -122,7 +172,7 @@ def plot_errors(df, df_avg, iwv_list, h_scale_factor, show_plots):
     plt.grid()
     plt.tight_layout()
     os.makedirs("plots", exist_ok=True)
-    plt.savefig(f"plots/error_iwv_{df_avg.index[0].year}_hf{int(h_scale_factor)}.png")
+    plt.savefig(f"plots/error_iwv_{df_ref['Time'].iloc[0].year}_hf{int(h_scale_factor)}.png")
     if show_plots:
         plt.show()
     plt.close()
@@ -132,6 +182,9 @@ def main():
     year = args.year
     h_scale_factor = args.h_factor
     show_plots = args.show
+    # Sin --show basta con el backend no interactivo
+    if not show_plots:
+        matplotlib.use("Agg")
 
     # Cargar datos
     df = load_humtemp(year)
@@ -4,7 +4,9 @@ Script para calcular la opacidad atmosférica a partir de ficheros de IWV usando
 
 - Toma cualquier cantidad de ficheros CSV con columnas 'Time' e 'IWV'.
 - Para cada valor de IWV y para cada frecuencia indicada, sustituye %0 (IWV) y %1 (frecuencia) en input.atm y ejecuta ./atm/atm.
+- Agrupa varios valores de IWV en una misma ejecución de ATM (si no es posible, ejecuta ATM para cada valor).
 - Extrae el valor de 'total atmospheric opacity' (primera columna) de la salida.
+- Guarda las opacidades calculadas en data/atm_cache.sqlite para reutilizarlas en ejecuciones posteriores.
 - Representa una curva de opacidad para cada fichero y frecuencia, con leyenda, y guarda la imagen en ./plots.
 
 Uso:
@@ -12,14 +14,36 @@ Uso:
 """
 
 import argparse
+import functools
+import hashlib
+import multiprocessing as mp
 import pandas as pd
 import subprocess
 import os
+import re
+import sqlite3
+import matplotlib
 import matplotlib.pyplot as plt
 
+# Si pyarrow está instalado se usa su lector de CSV (multihilo); si no, el de pandas
+try:
+    import pyarrow  # noqa: F401
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
 ATM_EXEC = "./atm/atm"
 ATM_INPUT_TEMPLATE = "./atm/input.atm"
 PLOTS_DIR = "plots"
+IWV_DECIMALS = 3  # Decimales a los que se redondea el IWV antes de llamar a ATM
+OPACITY_LABEL = "total atmospheric opacity"
+ATM_BATCH_SIZE = 5000  # Máximo de valores de IWV que se calculan en una misma ejecución de ATM
+
+ATM_CACHE_DB = "data/atm_cache.sqlite"  # Caché en disco de opacidades calculadas por ATM
+
+# Opacidades ya calculadas, por (plantilla, IWV redondeado, frecuencia)
+_opacity_cache = {}
+_cache_conn = None
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Calcula la opacidad atmosférica usando ATM para varios ficheros de IWV y varias frecuencias.")
@@ -28,14 +52,34 @@ def parse_args():
     parser.add_argument('--freq', required=True, help='Lista de frecuencias en GHz separadas por coma (ej: 41.2,43.0)')
     return parser.parse_args()
 
-def run_atm_with_iwv_and_freq(iwv_value, freq_value, atm_input_template):
+@functools.lru_cache(maxsize=4)
+def _load_template(path):
+    """
+    Lee la plantilla de ATM; se guarda en memoria para no releerla en cada fichero y frecuencia.
+    """
+    with open(path, 'r') as f:
+        return f.read()
+
+def _get_cache_conn():
+    """
+    Abre (una sola vez) la base de datos SQLite con las opacidades ya calculadas.
+    """
+    global _cache_conn
+    if _cache_conn is None:
+        os.makedirs(os.path.dirname(ATM_CACHE_DB), exist_ok=True)
+        _cache_conn = sqlite3.connect(ATM_CACHE_DB)
+        _cache_conn.execute(
+            "CREATE TABLE IF NOT EXISTS atm_cache ("
+            "template TEXT, iwv REAL, freq REAL, opacity REAL, "
+            "PRIMARY KEY (template, iwv, freq))"
+        )
+    return _cache_conn
+
+def run_atm_with_iwv_and_freq(iwv_value, freq_value, atm_input):
     """
-    Sustituye todas las ocurrencias de %0 (IWV) y %1 (frecuencia) en el fichero input.atm y ejecuta ATM.
+    Sustituye todas las ocurrencias de %0 (IWV) y %1 (frecuencia) en el contenido de input.atm y ejecuta ATM.
     Devuelve la salida del programa ATM.
     """
-    # Leer plantilla
-    with open(atm_input_template, 'r') as f:
-        atm_input = f.read()
     atm_input_filled = atm_input.replace('%0', f"{iwv_value}").replace('%1', f"{freq_value}")
 
     # Ejecutar ATM pasando la entrada por stdin
@@ -53,43 +97,167 @@ def run_atm_with_iwv_and_freq(iwv_value, freq_value, atm_input_template):
         output = ""
     return output
 
+def run_atm_batch(iwv_values, freq_value, atm_input):
+    """
+    Ejecuta ATM una sola vez para varios valores de IWV, repitiendo el contenido de input.atm
+    (sin la orden 'exit') para cada valor y terminando con un único 'exit'.
+    Devuelve la salida del programa ATM. _run_batch comprueba que el resultado coincide con el de ejecuciones individuales.
+    """
+    bloque = "".join(line + "\n" for line in atm_input.splitlines() if line.strip() != "exit")
+    atm_input_filled = "".join(bloque.replace('%0', f"{iwv}").replace('%1', f"{freq_value}") for iwv in iwv_values)
+    atm_input_filled += "exit\n"
+
+    try:
+        result = subprocess.run(
+            [ATM_EXEC],
+            input=atm_input_filled,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        output = result.stdout
+    except subprocess.CalledProcessError as e:
+        print(f"Error ejecutando ATM para {len(iwv_values)} valores de IWV, freq={freq_value}: {e}")
+        output = ""
+    return output
+
+def _parse_opacity_line(line):
+    """
+    Devuelve la primera columna de una línea 'total atmospheric opacity', o None si no se puede leer.
+    """
+    # Ejemplo de línea: total atmospheric opacity    =      0.0773         0.0469
+    parts = line.split("=")
+    if len(parts) > 1:
+        values = parts[1].split()
+        try:
+            return float(values[0])
+        except (IndexError, ValueError):
+            return None
+    return None
+
+def _find_opacity_lines(atm_output):
+    """
+    Recorre la salida de ATM buscando directamente 'total atmospheric opacity' y devuelve cada línea
+    que empieza por ese texto (sin contar los espacios iniciales) y contiene un '='.
+    """
+    pos = atm_output.find(OPACITY_LABEL)
+    while pos >= 0:
+        start = atm_output.rfind("\n", 0, pos) + 1
+        end = atm_output.find("\n", pos)
+        if end < 0:
+            end = len(atm_output)
+        line = atm_output[pos:end]
+        # Se ignoran las menciones en mitad de otra línea y las líneas sin valor
+        if not atm_output[start:pos].strip() and "=" in line:
+            yield line
+        pos = atm_output.find(OPACITY_LABEL, end)
+
 def extract_opacity(atm_output):
     """
     Extrae el valor de 'total atmospheric opacity' (primera columna) de la salida de ATM.
     """
-    for line in atm_output.splitlines():
-        if line.strip().startswith("total atmospheric opacity"):
-            # Ejemplo de línea: total atmospheric opacity    =      0.0773         0.0469
-            parts = line.split("=")
-            if len(parts) > 1:
-                values = parts[1].split()
-                try:
-                    return float(values[0])
-                except (IndexError, ValueError):
-                    return None
+    for line in _find_opacity_lines(atm_output):
+        opacity = _parse_opacity_line(line)
+        if opacity is not None:
+            return opacity
     return None
 
-def process_file(csv_file, atm_input_template, freq, period=1):
+def extract_opacities(atm_output):
     """
-    Procesa un fichero CSV, ejecuta ATM para cada IWV (cada 'period' muestras) y devuelve listas de fechas y opacidades.
+    Extrae todos los valores de 'total atmospheric opacity' de la salida de ATM, en orden.
+    """
+    return [_parse_opacity_line(line) for line in _find_opacity_lines(atm_output)]
+
+def _run_one(args):
+    """
+    Ejecuta ATM para una tupla (iwv, freq, plantilla) y devuelve la opacidad.
+    Está a nivel de módulo para poder usarse desde multiprocessing.Pool.
+    """
+    iwv, freq, atm_input = args
+    return extract_opacity(run_atm_with_iwv_and_freq(iwv, freq, atm_input))
+
+def _run_batch(args):
     """
-    df = pd.read_csv(csv_file)
-    if 'Time' not in df.columns or 'IWV' not in df.columns:
+    Ejecuta ATM para una tupla (lista de iwv, freq, plantilla) y devuelve la lista de opacidades.
+    Si la salida no tiene una opacidad por cada IWV, o si el último valor no coincide con el de una
+    ejecución independiente de ATM, repite el cálculo ejecutando ATM para cada valor.
+    """
+    iwv_values, freq, atm_input = args
+    opacities = extract_opacities(run_atm_batch(iwv_values, freq, atm_input))
+    if len(opacities) != len(iwv_values):
+        return [_run_one((iwv, freq, atm_input)) for iwv in iwv_values]
+
+    # Se supone que cada bloque de la entrada se calcula igual que en una ejecución nueva de ATM.
+    # Se comprueba con el último valor (el que más bloques tiene por delante) para no guardar resultados erróneos en la caché
+    if len(iwv_values) > 1 and opacities[-1] != _run_one((iwv_values[-1], freq, atm_input)):
+        print(f"La ejecución agrupada de ATM no coincide con una ejecución individual (freq={freq}); se calcula cada valor por separado.")
+        return [_run_one((iwv, freq, atm_input)) for iwv in iwv_values]
+    return opacities
+
+def load_iwv_file(csv_file, period=1):
+    """
+    Lee un fichero CSV con columnas 'Time' e 'IWV' y devuelve fechas e IWV (cada 'period' muestras).
+    """
+    # Comprobar la cabecera antes de leer, ya que parse_dates falla si no existe la columna 'Time'
+    columns = pd.read_csv(csv_file, nrows=0).columns
+    if 'Time' not in columns or 'IWV' not in columns:
         raise ValueError(f"El fichero {csv_file} debe contener columnas 'Time' e 'IWV'.")
+    df = pd.read_csv(csv_file, parse_dates=['Time'], engine=CSV_ENGINE)
 
     # Seleccionar solo una de cada 'period' muestras
-    df = df.iloc[::period].reset_index(drop=True)
+    if period > 1:
+        df = df.iloc[::period].reset_index(drop=True)
+
+    return df['Time'], df['IWV']
+
+def atm_over_iwvs(iwvs, freq, atm_input_template):
+    """
+    Ejecuta ATM para cada valor de la serie de IWV a la frecuencia dada y devuelve la lista de opacidades.
+    """
+    atm_input = _load_template(atm_input_template)
+
+    # ATM solo se ejecuta una vez por cada valor distinto de IWV (redondeado); los NaN (código -1) no se calculan
+    codes, unique_iwvs = pd.factorize(iwvs.round(IWV_DECIMALS))
+
+    # La caché depende del contenido de la plantilla: si input.atm cambia, se vuelve a calcular
+    template_key = hashlib.md5(atm_input.encode()).hexdigest()
+
+    missing = [iwv for iwv in unique_iwvs if (template_key, iwv, freq) not in _opacity_cache]
+    if missing:
+        # Cargar las opacidades guardadas en disco en ejecuciones anteriores
+        conn = _get_cache_conn()
+        rows = conn.execute("SELECT iwv, opacity FROM atm_cache WHERE template = ? AND freq = ?", (template_key, freq))
+        _opacity_cache.update(((template_key, iwv, freq), opacity) for iwv, opacity in rows)
 
-    times = pd.to_datetime(df['Time'])
-    iwvs = df['IWV']
+    # Solo se calculan los valores que no están ya en la caché (por ejemplo, de otro fichero o de otra ejecución)
+    pending = [iwv for iwv in missing if (template_key, iwv, freq) not in _opacity_cache]
+    if pending:
+        # Cada ejecución de ATM calcula un bloque de valores; los bloques se reparten entre todos los núcleos manteniendo el orden.
+        # Se usa un bloque por núcleo (hasta ATM_BATCH_SIZE valores) para arrancar ATM el menor número de veces posible,
+        # suponiendo que ATM calcula igual varios bloques seguidos que en ejecuciones separadas (_run_batch lo comprueba)
+        n_workers = os.cpu_count() or 1
+        batch_size = min(ATM_BATCH_SIZE, -(-len(pending) // n_workers))
+        args_iter = ((pending[i:i + batch_size], freq, atm_input) for i in range(0, len(pending), batch_size))
+        with mp.Pool(n_workers) as pool:
+            new_opacities = [opacity for batch in pool.imap(_run_batch, args_iter) for opacity in batch]
+        _opacity_cache.update(((template_key, iwv, freq), opacity) for iwv, opacity in zip(pending, new_opacities))
 
-    opacities = []
-    for iwv in iwvs:
-        atm_output = run_atm_with_iwv_and_freq(iwv, freq, atm_input_template)
-        opacity = extract_opacity(atm_output)
-        opacities.append(opacity)
+        # Guardar en disco solo los resultados válidos, para reintentar los fallidos la próxima vez
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO atm_cache (template, iwv, freq, opacity) VALUES (?, ?, ?, ?)",
+                ((template_key, float(iwv), freq, opacity) for iwv, opacity in zip(pending, new_opacities) if opacity is not None)
+            )
 
-    return times, opacities
+    unique_opacities = [_opacity_cache[(template_key, iwv, freq)] for iwv in unique_iwvs]
+    return [unique_opacities[c] if c >= 0 else None for c in codes]
+
+def process_file(csv_file, atm_input_template, freq, period=1):
+    """
+    Procesa un fichero CSV, ejecuta ATM para cada IWV (cada 'period' muestras) y devuelve listas de fechas y opacidades.
+    """
+    times, iwvs = load_iwv_file(csv_file, period)
+    return times, atm_over_iwvs(iwvs, freq, atm_input_template)
 
 def plot_opacities(results, freq):
     """
@@ -112,12 +280,10 @@ def plot_opacities(results, freq):
 
 def error_relativo(opacidad1, opacidad2):
     """
-    Calcula el error relativo entre dos valores de opacidad.
+    Calcula el error relativo entre dos series de opacidad.
     Modifica aquí la fórmula si lo necesitas en el futuro.
     """
-    if opacidad1 == 0 or opacidad1 is None or opacidad2 is None:
-        return None
-    return abs(opacidad1 - opacidad2) / opacidad1
+    return (opacidad1 - opacidad2).abs() / opacidad1.where(opacidad1 != 0)
 
 def plot_error_relativo(results, freq):
     """
@@ -133,22 +299,17 @@ def plot_error_relativo(results, freq):
     times1, opacities1 = results[labels[0]]
     times2, opacities2 = results[labels[1]]
 
-    # Redondear los tiempos a minutos para comparar
-    times1_rounded = pd.to_datetime(times1).dt.floor('min')
-    times2_rounded = pd.to_datetime(times2).dt.floor('min')
-
-    # Crear diccionarios para acceso rápido
-    dict1 = dict(zip(times1_rounded, opacities1))
-    dict2 = dict(zip(times2_rounded, opacities2))
+    # Los instantes vacíos o no válidos (NaT) no se pueden emparejar
+    df1 = pd.DataFrame({"t": pd.to_datetime(times1, errors="coerce"), "o1": opacities1}).dropna(subset=["t"]).sort_values("t")
+    df2 = pd.DataFrame({"t": pd.to_datetime(times2, errors="coerce"), "o2": opacities2}).dropna(subset=["t"]).sort_values("t")
 
-    # Intersección de fechas
-    common_times = sorted(set(dict1.keys()) & set(dict2.keys()))
+    # Emparejar cada instante con el más cercano de la otra fuente (como máximo a 1 minuto)
+    merged = pd.merge_asof(df1, df2, on="t", tolerance=pd.Timedelta("1min"), direction="nearest")
+    merged["error"] = error_relativo(merged["o1"].astype(float), merged["o2"].astype(float))
+    merged = merged.dropna(subset=["error"])
 
-    error_rel = [error_relativo(dict1[t], dict2[t]) for t in common_times]
-
-    # Filtrar posibles None
-    filtered_times = [t for t, e in zip(common_times, error_rel) if e is not None]
-    filtered_errors = [e for e in error_rel if e is not None]
+    filtered_times = merged["t"]
+    filtered_errors = merged["error"]
 
     # Graficar
     plt.figure(figsize=(12, 6))
@@ -163,32 +324,37 @@ def plot_error_relativo(results, freq):
     plt.close()
     print(f"Gráfica de desviación relativa guardada en {os.path.join(PLOTS_DIR, f'desviacion_relativa_opacidad_{freq_str}.png')}")
 
+def file_label(csv_file):
+    """
+    Determina la etiqueta de la leyenda según el formato del nombre del archivo.
+    """
+    basename = os.path.basename(csv_file)
+    if basename.startswith("Avg_data"):
+        return "GNSS"
+    if basename.startswith("IWV_calculado"):
+        # Extraer factor de escala H del formato *hf{factor}.csv
+        match = re.search(r'hf(\d+(?:\.\d+)?)\.csv', basename)
+        if match:
+            h_factor = match.group(1)
+            return f"Atmospheric Parameters (H ={h_factor})"
+    return basename
+
 def main():
     args = parse_args()
+    # Solo se guardan imágenes, no hace falta backend gráfico
+    matplotlib.use("Agg")
     freq_list = [float(f) for f in args.freq.split(",")]
+
+    # Cada fichero se lee una sola vez y se reutiliza para todas las frecuencias
+    parsed = {}
+    for csv_file in args.files:
+        parsed[file_label(csv_file)] = load_iwv_file(csv_file, period=args.period)
+
     for freq in freq_list:
         results = {}
-        for csv_file in args.files:
-            print(f"Procesando {csv_file} para frecuencia {freq} GHz...")
-            
-            # Determinar label según el formato del archivo
-            basename = os.path.basename(csv_file)
-            if basename.startswith("Avg_data"):
-                label = "GNSS"
-            elif basename.startswith("IWV_calculado"):
-                # Extraer factor de escala H del formato *hf{factor}.csv
-                import re
-                match = re.search(r'hf(\d+(?:\.\d+)?)\.csv', basename)
-                if match:
-                    h_factor = match.group(1)
-                    label = f"Atmospheric Parameters (H ={h_factor})"
-                else:
-                    label = basename
-            else:
-                label = basename
-            
-            times, opacities = process_file(csv_file, ATM_INPUT_TEMPLATE, freq, period=args.period)
-            results[label] = (times, opacities)
+        for label, (times, iwvs) in parsed.items():
+            print(f"Procesando {label} para frecuencia {freq} GHz...")
+            results[label] = (times, atm_over_iwvs(iwvs, freq, ATM_INPUT_TEMPLATE))
         plot_opacities(results, freq)
         plot_error_relativo(results, freq)
 